@@ -8,6 +8,7 @@ import pathlib
 import os
 import subprocess
 import shutil
+import tempfile
 import textwrap
 import time
 import utils
@@ -19,6 +20,9 @@ from urllib.error import URLError
 # To bump this, run 'PATH_OVERRIDE=<path_to_updated_toolchain>/bin kernel/build.sh --allyesconfig'
 GOOD_REVISION = '09ac3523b6729c9300e044081c442c304602cfd9'
 
+# Marks a build folder that was moved out of the way by cleanup() for removal
+OLD_BUILD_MARKER = '.tc-build-old'
+
 
 class Directories:
     def __init__(self, build_folder, install_folder, linux_folder,
@@ -174,7 +178,8 @@ def parse_parameters(root_folder):
                         "--incremental",
                         help=textwrap.dedent("""\
                         By default, the script removes all build artifacts from previous compiles. This
-                        prevents that, allowing for dirty builds and faster compiles.
+                        prevents that, allowing for dirty builds and faster compiles. cmake will only be run
+                        again for a stage if its configuration is different from its last successful build.
 
                         """),
                         action="store_true")
@@ -218,7 +223,9 @@ def parse_parameters(root_folder):
                         is much worse and is not worth considering unless you have a server available to build on.
 
                         This option should not be used with '--build-stage1-only' unless you know that your
-                        host compiler and linker support it. See the two links below for more information.
+                        host compiler and linker support it. The number of parallel link jobs is limited based
+                        on the amount of memory and CPUs in the machine, which can be overridden with
+                        '-D LLVM_PARALLEL_LINK_JOBS=<jobs>'. See the two links below for more information.
 
                         https://llvm.org/docs/LinkTimeOptimization.html
                         https://clang.llvm.org/docs/ThinLTO.html
@@ -304,6 +311,17 @@ def parse_parameters(root_folder):
                                  'kernel-defconfig', 'kernel-allmodconfig',
                                  'kernel-allyesconfig', 'llvm'
                              ])
+    parser.add_argument("--reuse-stage1",
+                        help=textwrap.dedent("""\
+                        By default, the script builds the stage 1 compiler from scratch on every run. When doing
+                        multiple multi-stage builds with different final stage options (like '--lto' or '--pgo'),
+                        this option keeps the stage 1 folder from the previous run and skips building stage 1 if
+                        it was configured in exactly the same way from the same LLVM revision. Otherwise, stage 1
+                        is built from scratch. Uncommitted changes to the LLVM source are not detected and this
+                        option has no effect if the LLVM source is not a git repo.
+
+                        """),
+                        action="store_true")
     clone_options.add_argument("-s",
                                "--shallow-clone",
                                help=textwrap.dedent("""\
@@ -523,15 +541,17 @@ def repo_is_shallow(repo):
 
 def ref_exists(repo, ref):
     """
-    Check if ref exists using show-branch (works for branches, tags, and raw SHAs)
+    Check if ref exists using rev-parse (works for branches, tags, and raw SHAs)
     :param repo: The path to the repo to check
     :param ref: The ref to check
     :return: True if ref exits, False if not
     """
-    return subprocess.run(["git", "show-branch", ref],
-                          stderr=subprocess.STDOUT,
-                          stdout=subprocess.DEVNULL,
-                          cwd=repo.as_posix()).returncode == 0
+    return subprocess.run(
+        ["git", "rev-parse", "--verify", "-q",
+         "%s^{commit}" % ref],
+        stderr=subprocess.STDOUT,
+        stdout=subprocess.DEVNULL,
+        cwd=repo.as_posix()).returncode == 0
 
 
 def fetch_llvm_binutils(root_folder, update, shallow, ref):
@@ -590,7 +610,13 @@ def fetch_llvm_binutils(root_folder, update, shallow, ref):
     else:
         utils.print_header("Downloading LLVM")
 
-        extra_args = ()
+        # Only the tree of the requested revision is needed to build, so do a
+        # partial clone that fetches the history without the blobs; the
+        # blobs for other revisions will be fetched on demand if they are
+        # ever checked out. Skip checking out the default branch so that only
+        # the blobs of the requested revision are fetched by the checkout
+        # below.
+        extra_args = ("--filter=blob:none", "--no-checkout")
         if shallow:
             extra_args = ("--depth", "1")
             if ref != "main":
@@ -610,15 +636,54 @@ def fetch_llvm_binutils(root_folder, update, shallow, ref):
     utils.download_binutils(root_folder)
 
 
-def cleanup(build_folder, incremental):
+def cleanup(build_folder, incremental, reuse_stage1):
     """
     Clean up and create the build folder
     :param build_folder: The build directory
     :param incremental: Whether the build is incremental or not.
+    :param reuse_stage1: Whether the stage 1 folder should be preserved or not.
+                         This should only be true when it can be reused as is.
     :return:
     """
     if not incremental and build_folder.is_dir():
-        shutil.rmtree(build_folder.as_posix())
+        if build_folder.is_symlink() or os.path.ismount(
+                build_folder.as_posix()):
+            # The folder itself cannot be moved out of the way (it would move
+            # the symlink or fail for a mount point) so remove its contents
+            for entity in build_folder.iterdir():
+                if reuse_stage1 and entity.name == "stage1":
+                    continue
+                if entity.is_dir() and not entity.is_symlink():
+                    shutil.rmtree(entity.as_posix())
+                else:
+                    entity.unlink()
+        else:
+            # Removing a full build folder can take quite a while, move it out
+            # of the way (which is instant on the same filesystem) and remove
+            # it in the background so that the build can start right away.
+            # Pick up any old build folders that were left behind by an
+            # interrupted run too, which are identified by a marker file so
+            # that nothing this script did not create is ever removed.
+            prefix = ".%s.tc-build-old." % build_folder.name
+            old_build_folder = pathlib.Path(
+                tempfile.mkdtemp(dir=build_folder.parent.as_posix(),
+                                 prefix=prefix))
+            old_build_folder.joinpath(OLD_BUILD_MARKER).touch()
+            build_folder.rename(old_build_folder.joinpath(build_folder.name))
+            build_folder.mkdir(parents=True)
+            old_stage1 = old_build_folder.joinpath(build_folder.name, "stage1")
+            if reuse_stage1 and old_stage1.is_dir():
+                old_stage1.rename(build_folder.joinpath("stage1"))
+            old_build_folders = [
+                folder for folder in glob.glob(
+                    os.path.join(glob.escape(build_folder.parent.as_posix()),
+                                 glob.escape(prefix) + "*"))
+                if os.path.isfile(os.path.join(folder, OLD_BUILD_MARKER))
+            ]
+            subprocess.Popen(["rm", "-fr"] + old_build_folders,
+                             start_new_session=True,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
     build_folder.mkdir(parents=True, exist_ok=True)
 
 
@@ -903,6 +968,21 @@ def target_cmake_defines(args, stage):
     return defines
 
 
+def lto_link_jobs(lto):
+    """
+    Calculate how many LTO link jobs can run in parallel without running out of
+    memory, which is bounded by both the amount of memory and number of CPUs
+    :param lto: The type of LTO being done (thin or full)
+    :return: The number of link jobs to run in parallel
+    """
+    # Rough estimate of the peak memory usage in GB of linking one of the
+    # large LLVM binaries (like clang) with LTO
+    per_job_mem = {'full': 30, 'thin': 15}
+    mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024**3
+    cpus = len(os.sched_getaffinity(0))
+    return max(1, min(cpus, mem // per_job_mem[lto]))
+
+
 def stage_specific_cmake_defines(args, dirs, stage):
     """
     Generate other stage specific defines
@@ -954,6 +1034,11 @@ def stage_specific_cmake_defines(args, dirs, stage):
                     "profdata.prof").as_posix()
             if args.lto:
                 defines['LLVM_ENABLE_LTO'] = args.lto.capitalize()
+                # LTO links use a lot of memory so limit how many of them can
+                # run at once, unless the user already did
+                if not 'LLVM_PARALLEL_LINK_JOBS' in str(args.defines):
+                    defines['LLVM_PARALLEL_LINK_JOBS'] = str(
+                        lto_link_jobs(args.lto))
 
         # If the user did not specify CMAKE_C_FLAGS or CMAKE_CXX_FLAGS, add them as empty
         # to paste stage 2 to ensure there are no environment issues (since CFLAGS and CXXFLAGS
@@ -1015,7 +1100,8 @@ def show_command(args, command):
     :param command: The command being run
     """
     if args.show_build_commands:
-        print("$ %s" % " ".join([str(element) for element in command]))
+        print("$ %s" % " ".join([str(element) for element in command]),
+              flush=True)
 
 
 def get_pgo_header_folder(stage):
@@ -1029,16 +1115,15 @@ def get_pgo_header_folder(stage):
     return (header_string, sub_folder)
 
 
-def invoke_cmake(args, dirs, env_vars, stage):
+def get_cmake_command(args, dirs, env_vars, stage):
     """
-    Invoke cmake to generate the build files
+    Generate the cmake invocation for a stage
     :param args: The args variable generated by parse_parameters
     :param dirs: An instance of the Directories class with the paths to use
     :param env_vars: An instance of the EnvVars class with the compilers/linker to use
     :param stage: What stage we are at
-    :return:
+    :return: A list suitable for passing to subprocess
     """
-    # Add the defines, point them to our build folder, and invoke cmake
     cmake = ['cmake', '-G', 'Ninja', '-Wno-dev']
     defines = build_cmake_defines(args, dirs, env_vars, stage)
     for key in defines:
@@ -1049,16 +1134,141 @@ def invoke_cmake(args, dirs, env_vars, stage):
             cmake += ['-D' + d]
     cmake += [dirs.root_folder.joinpath("llvm-project", "llvm").as_posix()]
 
+    return cmake
+
+
+def invoke_cmake(args, dirs, env_vars, stage):
+    """
+    Invoke cmake to generate the build files
+    :param args: The args variable generated by parse_parameters
+    :param dirs: An instance of the Directories class with the paths to use
+    :param env_vars: An instance of the EnvVars class with the compilers/linker to use
+    :param stage: What stage we are at
+    :return:
+    """
+    # Add the defines, point them to our build folder, and invoke cmake
+    cmake = get_cmake_command(args, dirs, env_vars, stage)
+
     header_string, sub_folder = get_pgo_header_folder(stage)
 
     cwd = dirs.build_folder.joinpath(sub_folder).as_posix()
 
+    # ninja reruns cmake by itself when any of the CMake files change, so in an
+    # incremental build, cmake only needs to be run again if the configuration
+    # is different from the last successful build of this stage
+    if args.incremental and cmake_stamp_matches(args, dirs, env_vars, stage):
+        utils.print_header("Configuration of LLVM %s is unchanged" %
+                           header_string)
+        return
+
+    # The stamp is only written again once this stage has been fully built
+    remove_cmake_stamp(dirs, stage)
+
     utils.print_header("Configuring LLVM %s" % header_string)
 
     show_command(args, cmake)
     subprocess.run(cmake, check=True, cwd=cwd)
 
 
+def cmake_stamp_file(dirs, stage):
+    """
+    Returns the path of the stamp that records how a stage was configured
+    :param dirs: An instance of the Directories class with the paths to use
+    :param stage: What stage we are at
+    :return: A path to the stamp file
+    """
+    _, sub_folder = get_pgo_header_folder(stage)
+    return dirs.build_folder.joinpath(sub_folder, ".tc-build-cmake")
+
+
+def remove_cmake_stamp(dirs, stage):
+    """
+    Remove the stamp of a stage so that it is not considered to be built
+    :param dirs: An instance of the Directories class with the paths to use
+    :param stage: What stage we are at
+    :return:
+    """
+    stamp = cmake_stamp_file(dirs, stage)
+    if stamp.exists():
+        stamp.unlink()
+
+
+def cmake_stamp(args, dirs, env_vars, stage):
+    """
+    Generate the stamp that records how a stage was configured when it was last
+    successfully built
+    :param args: The args variable generated by parse_parameters
+    :param dirs: An instance of the Directories class with the paths to use
+    :param env_vars: An instance of the EnvVars class with the compilers/linker to use
+    :param stage: What stage we are at
+    :return: A tuple of the stamp file and its expected contents, which are None
+             when the LLVM revision cannot be determined
+    """
+    stamp = cmake_stamp_file(dirs, stage)
+    # Record the LLVM revision too, as a stage built from an older revision
+    # cannot be reused
+    revision = llvm_revision(dirs.root_folder)
+    if revision is None:
+        return stamp, None
+    cmake = get_cmake_command(args, dirs, env_vars, stage)
+    return stamp, revision + "\n".join(cmake)
+
+
+def llvm_revision(root_folder):
+    """
+    Gets the revision that the llvm-project repo is checked out at
+    :param root_folder: Working directory
+    :return: The hash of HEAD or None if llvm-project is not a git repo
+    """
+    llvm_project = root_folder.joinpath("llvm-project")
+    # llvm-project may not be a git repo (such as when it is from a release
+    # tarball), in which case git could find the repo of a parent folder
+    try:
+        toplevel = subprocess.check_output(
+            ["git", "rev-parse", "--show-toplevel"],
+            cwd=llvm_project.as_posix(),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+    if pathlib.Path(toplevel).resolve() != llvm_project.resolve():
+        return None
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                   cwd=llvm_project.as_posix()).decode()
+
+
+def cmake_stamp_matches(args, dirs, env_vars, stage):
+    """
+    Returns true if a stage was last successfully built with the same configuration
+    :param args: The args variable generated by parse_parameters
+    :param dirs: An instance of the Directories class with the paths to use
+    :param env_vars: An instance of the EnvVars class with the compilers/linker to use
+    :param stage: What stage we are at
+    :return: True if the configuration is unchanged, false if not
+    """
+    stamp, contents = cmake_stamp(args, dirs, env_vars, stage)
+    if contents is None:
+        return False
+    # cmake cannot be skipped if its output has been removed
+    for cmake_file in ["build.ninja", "CMakeCache.txt"]:
+        if not stamp.with_name(cmake_file).is_file():
+            return False
+    return stamp.is_file() and stamp.read_text() == contents
+
+
+def write_cmake_stamp(args, dirs, env_vars, stage):
+    """
+    Record how a stage was configured after it has been successfully built
+    :param args: The args variable generated by parse_parameters
+    :param dirs: An instance of the Directories class with the paths to use
+    :param env_vars: An instance of the EnvVars class with the compilers/linker to use
+    :param stage: What stage we are at
+    :return:
+    """
+    stamp, contents = cmake_stamp(args, dirs, env_vars, stage)
+    if contents is not None:
+        stamp.write_text(contents)
+
+
 def print_install_info(install_folder):
     """
     Prints out where the LLVM toolchain is installed, how to add to PATH, and version information
@@ -1076,11 +1286,11 @@ def print_install_info(install_folder):
     clang = bin_folder.joinpath("clang")
     lld = bin_folder.joinpath("ld.lld")
     if clang.exists() or lld.exists():
-        print("Version information:\n")
+        print("Version information:\n", flush=True)
         for binary in [clang, lld]:
             if binary.exists():
                 subprocess.run([binary, "--version"], check=True)
-                print()
+                print(flush=True)
 
 
 def ninja_check(args, build_folder):
@@ -1102,7 +1312,7 @@ def invoke_ninja(args, dirs, stage):
     :param args: The args variable generated by parse_parameters
     :param dirs: An instance of the Directories class with the paths to use
     :param stage: The current stage we're building
-    :return:
+    :return: How long the build took in seconds
     """
     header_string, sub_folder = get_pgo_header_folder(stage)
 
@@ -1126,9 +1336,10 @@ def invoke_ninja(args, dirs, stage):
     if stage == get_final_stage(args):
         ninja_check(args, build_folder)
 
+    duration = int(time.time() - time_started)
+
     print()
-    print("LLVM build duration: " +
-          str(datetime.timedelta(seconds=int(time.time() - time_started))))
+    print("LLVM build duration: " + str(datetime.timedelta(seconds=duration)))
 
     if should_install_toolchain(args, stage):
         subprocess.run(['ninja', 'install'],
@@ -1142,6 +1353,8 @@ def invoke_ninja(args, dirs, stage):
     if install_folder is not None:
         print_install_info(install_folder)
 
+    return duration
+
 
 def kernel_build_sh(args, config, dirs):
     """
@@ -1178,7 +1391,11 @@ def pgo_llvm_build(args, dirs):
     stage = "pgo"
     dirs.build_folder.joinpath(stage).mkdir(parents=True, exist_ok=True)
     invoke_cmake(args, dirs, None, stage)
+    # The stamp may still be around if cmake was skipped, it is only valid
+    # again once ninja finishes
+    remove_cmake_stamp(dirs, stage)
     invoke_ninja(args, dirs, stage)
+    write_cmake_stamp(args, dirs, None, stage)
 
 
 def generate_pgo_profiles(args, dirs):
@@ -1208,6 +1425,19 @@ def generate_pgo_profiles(args, dirs):
                    check=True)
 
 
+def can_reuse_stage1(args, dirs, env_vars):
+    """
+    Returns true if the requested stage 1 build can be reused from a previous run
+    :param args: The args variable generated by parse_parameters
+    :param dirs: An instance of the Directories class with the paths to use
+    :param env_vars: An instance of the EnvVars class with the compilers/linker to use
+    :return: True if stage 1 was built with the same configuration, false if not
+    """
+    if not args.reuse_stage1 or not bootstrap_stage(args, 1):
+        return False
+    return cmake_stamp_matches(args, dirs, env_vars, 1)
+
+
 def do_multistage_build(args, dirs, env_vars):
     stages = [1]
 
@@ -1216,14 +1446,43 @@ def do_multistage_build(args, dirs, env_vars):
         if args.pgo:
             stages += [3]
 
+    durations = []
     for stage in stages:
+        if stage == 1 and can_reuse_stage1(args, dirs, env_vars):
+            utils.print_header("Reusing LLVM stage 1")
+            continue
         dirs.build_folder.joinpath("stage%d" % stage).mkdir(parents=True,
                                                             exist_ok=True)
         invoke_cmake(args, dirs, env_vars, stage)
-        invoke_ninja(args, dirs, stage)
+        # The stamp may still be around if cmake was skipped, it is only valid
+        # again once ninja finishes
+        remove_cmake_stamp(dirs, stage)
+        durations += [("stage %d" % stage, invoke_ninja(args, dirs, stage))]
+        write_cmake_stamp(args, dirs, env_vars, stage)
         # Build profiles after stage 2 when using PGO
         if instrumented_stage(args, stage):
+            time_started = time.time()
             generate_pgo_profiles(args, dirs)
+            durations += [("PGO profiles", int(time.time() - time_started))]
+
+    print_build_durations(durations)
+
+
+def print_build_durations(durations):
+    """
+    Prints how long each part of a multi-stage build took, which makes it easy
+    to compare the cost of different build options
+    :param durations: A list of tuples of the part of the build and its duration in seconds
+    :return:
+    """
+    if len(durations) < 2:
+        return
+
+    utils.print_header("Build duration summary")
+    for name, duration in durations:
+        print("%-14s%s" % (name + ":", datetime.timedelta(seconds=duration)))
+    total = sum(duration for _, duration in durations)
+    print("%-14s%s\n" % ("total:", datetime.timedelta(seconds=total)))
 
 
 def main():
@@ -1257,8 +1516,11 @@ def main():
         ref = args.branch
     fetch_llvm_binutils(root_folder, not args.no_update, args.shallow_clone,
                         ref)
-    cleanup(build_folder, args.incremental)
     dirs = Directories(build_folder, install_folder, linux_folder, root_folder)
+    # Only keep stage 1 around if it will be reused, so that it is never
+    # reconfigured on top of a stale CMakeCache.txt
+    reuse_stage1 = can_reuse_stage1(args, dirs, env_vars)
+    cleanup(build_folder, args.incremental, reuse_stage1)
     do_multistage_build(args, dirs, env_vars)
 
 
@@ -32,6 +32,7 @@ function do_deps() {
         bc \
         bison \
         ca-certificates \
+        ccache \
         clang \
         cmake \
         curl \
@@ -57,8 +58,6 @@ function do_kernel() {
 }
 
 function do_llvm() {
-    EXTRA_ARGS=()
-    [[ -n ${GITHUB_ACTIONS:-} ]] && EXTRA_ARGS+=(--no-ccache)
     "${BASE}"/build-llvm.py \
         --assertions \
         --branch "release/12.x" \
@@ -67,8 +66,7 @@ function do_llvm() {
         --install-stage1-only \
         --projects "clang;lld" \
         --shallow-clone \
-        --targets X86 \
-        "${EXTRA_ARGS[@]}"
+        --targets X86
 }
 
 parse_parameters "${@}"
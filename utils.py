@@ -2,9 +2,11 @@
 # Description: Common helper functions
 
 import hashlib
+import os
 import pathlib
 import shutil
 import subprocess
+import urllib.request as request
 
 
 def create_gitignore(folder):
@@ -32,35 +34,68 @@ def download_binutils(folder):
     """
     binutils = current_binutils()
     binutils_folder = folder.joinpath(binutils)
+    binutils_tarball = folder.joinpath(binutils + ".tar.xz")
     if not binutils_folder.is_dir():
-        # Remove any previous copies of binutils
+        # Remove any previous copies of binutils, keeping the tarball of the
+        # current release around so that it does not need to be downloaded
+        # again if the source folder is removed
         for entity in folder.glob('binutils-*'):
+            if entity == binutils_tarball:
+                continue
             if entity.is_dir():
                 shutil.rmtree(entity.as_posix())
             else:
                 entity.unlink()
 
-        # Download the tarball
-        binutils_tarball = folder.joinpath(binutils + ".tar.xz")
-        subprocess.run([
-            "curl", "-LSs", "-o",
-            binutils_tarball.as_posix(),
-            "https://ftp.gnu.org/gnu/binutils/" + binutils_tarball.name
-        ],
-                       check=True)
-        verify_binutils_checksum(binutils_tarball)
-        # Extract the tarball then remove it
+        # Use the cached tarball if it is intact, otherwise download it again
+        if not binutils_tarball.is_file() or not binutils_checksum_matches(
+                hash_file(binutils_tarball)):
+            fetch_binutils_tarball(binutils_tarball)
+        # Extract the tarball
         subprocess.run(["tar", "-xJf", binutils_tarball.name],
                        check=True,
                        cwd=folder.as_posix())
         create_gitignore(binutils_folder)
-        binutils_tarball.unlink()
 
 
-def verify_binutils_checksum(file):
-    # Check the SHA512 checksum of the downloaded file with a known good one
-    # The sha512.sum file from <sourceware.org> ships the SHA512 checksums
-    # Link: https://sourceware.org/pub/binutils/releases/sha512.sum
+def fetch_binutils_tarball(binutils_tarball):
+    """
+    Downloads and verifies a binutils tarball
+    :param binutils_tarball: Path to download the tarball to
+    """
+    # Download to a temporary file and move it into place once it has been
+    # verified so that an interrupted or corrupted download is never mistaken
+    # for a good tarball. The tarball is hashed as it is written out so that
+    # the checksum verification does not need another pass over the file.
+    tmp_tarball = binutils_tarball.with_name(
+        "%s.%d.tmp" % (binutils_tarball.name, os.getpid()))
+    file_hash = hashlib.sha512()
+    try:
+        with request.urlopen("https://ftp.gnu.org/gnu/binutils/" +
+                             binutils_tarball.name,
+                             timeout=3600) as response:
+            with tmp_tarball.open("wb") as f:
+                while True:
+                    data = response.read(1048576)
+                    if not data:
+                        break
+                    file_hash.update(data)
+                    f.write(data)
+        if not binutils_checksum_matches(file_hash):
+            raise RuntimeError(
+                "binutils: SHA512 checksum does not match known good one!")
+        tmp_tarball.replace(binutils_tarball)
+    finally:
+        if tmp_tarball.exists():
+            tmp_tarball.unlink()
+
+
+def hash_file(file):
+    """
+    Computes the SHA512 hash of a file
+    :param file: File to hash
+    :return: A hashlib object with the contents of the file
+    """
     file_hash = hashlib.sha512()
     with file.open("rb") as f:
         while True:
@@ -68,10 +103,19 @@ def verify_binutils_checksum(file):
             if not data:
                 break
             file_hash.update(data)
+    return file_hash
+
+
+def binutils_checksum_matches(file_hash):
+    """
+    Checks the SHA512 checksum of a binutils tarball against a known good one
+    :param file_hash: A hashlib object with the contents of the tarball
+    :return: True if the checksum matches, False if not
+    """
+    # The sha512.sum file from <sourceware.org> ships the SHA512 checksums
+    # Link: https://sourceware.org/pub/binutils/releases/sha512.sum
     good_hash = "cc24590bcead10b90763386b6f96bb027d7594c659c2d95174a6352e8b98465a50ec3e4088d0da038428abe059bbc4ae5f37b269f31a40fc048072c8a234f4e9"
-    if file_hash.hexdigest() != good_hash:
-        raise RuntimeError(
-            "binutils: SHA512 checksum does not match known good one!")
+    return file_hash.hexdigest() == good_hash
 
 
 def print_header(string):
@@ -88,7 +132,9 @@ def print_header(string):
     for x in range(0, len(string) + 6):
         print("=", end="")
     # \033[0m resets the color back to the user's default
-    print("\n\033[0m")
+    # Flush so that the header shows up before the output of the command that
+    # follows it when stdout is not a terminal (like in CI)
+    print("\n\033[0m", flush=True)
 
 
 def print_error(string):
@@ -97,4 +143,4 @@ def print_error(string):
     :param string: String to print
     """
     # Use bold red for error
-    print("\033[01;31m%s\n\033[0m" % string)
+    print("\033[01;31m%s\n\033[0m" % string, flush=True)